@@ -26,5 +26,10 @@ program_description = "Show changes among two container images."
 
 docker_socket = "unix://var/run/docker.sock"
 silent = False
+ignore_volatile = False
+summary_depth = None
+max_diff_size = 10*1024*1024
+path_scope = None
+graph_driver = False
 
 from containerdiff.run import *
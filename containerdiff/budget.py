@@ -0,0 +1,70 @@
+#   ContainerDiff - tool to show differences among container images
+#
+#   Copyright (C) 2016 Marek Skalicky mskalick@redhat.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with containerdiff.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Limit the time of containerdiff run.
+
+When the time budget is set, modules do cheap tests first and check
+'exceeded' before expensive operations. Results which were not
+computed in time are marked as "not compared".
+"""
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Value used in the output for results which were not computed in time
+NOT_COMPARED = "not compared"
+
+# Value of time.monotonic() when the time budget ends (None if there is
+# no time budget)
+deadline = None
+
+class TimeBudgetExceeded(Exception):
+    """Raised when an operation can not be finished in time budget."""
+    pass
+
+def start(seconds):
+    """Set the time budget to 'seconds' from now. None means there is
+    no time limit.
+    """
+    global deadline
+    if seconds is None:
+        deadline = None
+    else:
+        logger.info("Time budget is %s seconds", seconds)
+        deadline = time.monotonic()+seconds
+
+def remaining():
+    """Return the number of seconds left or None if there is no time
+    budget.
+    """
+    if deadline is None:
+        return None
+    return max(0, deadline-time.monotonic())
+
+def exceeded():
+    """Return True if there is no time left."""
+    return deadline is not None and time.monotonic() >= deadline
+
+def check(operation):
+    """Raise TimeBudgetExceeded if there is no time left for
+    'operation' (string used in the error message).
+    """
+    if exceeded():
+        raise TimeBudgetExceeded("No time left for "+operation)
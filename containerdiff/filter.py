@@ -16,56 +16,140 @@
 #   along with containerdiff.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-"""Filter an output of modules."""
+"""Filter an output of modules.
+
+Filtering options are compiled into Filter objects once. Items of the
+output are matched by their fields (file path, package name, metadata
+path or MIME type) and not by their whole string representation, so
+the diffs of modified files are never searched. Path rules are stored
+in a trie (see pathscope.PathMatcher), so the cost of matching does not
+grow with the number of rules.
+"""
 
-import logging
 import re
+import json
+import logging
+
+from containerdiff.pathscope import PathMatcher
 
 logger = logging.getLogger(__name__)
 
+class Filter:
+    """Compiled filtering options of one key of the output.
+
+    Options are a dict (see filter.json for example or documentation of
+    containerdiff):
+    "action" - "include" or "exclude"
+    "keys"   - optional list of keys to filter if the output is a dict
+    "data"   - regular expressions matched to the first field of items
+    "paths"  - path prefixes or globs matched to the first field
+    "mime"   - regular expressions matched to the second field (MIME
+               type in the output of files module)
+
+    Raises ValueError if the options are not valid.
+    """
+
+    def __init__(self, options):
+        # Action key is mandatory
+        if not "action" in options or options["action"] not in ("include", "exclude"):
+            raise ValueError("wrong or missing \"action\" key in filter options")
+        for name in ("keys", "data", "paths", "mime"):
+            if name in options and not isinstance(options[name], list):
+                raise ValueError("\""+name+"\" filter option is not a list")
+        # Filtering options have to contain something to match
+        if not any(name in options for name in ("data", "paths", "mime")):
+            raise ValueError("missing \"data\", \"paths\" or \"mime\" key in filter options")
+
+        self.include = options["action"] == "include"
+        self.keys = options.get("keys")
+        self.data = re.compile("|".join(options["data"])) if options.get("data") else None
+        self.paths = PathMatcher(options["paths"]) if options.get("paths") else None
+        self.mime = re.compile("|".join(options["mime"])) if options.get("mime") else None
+
+    def __bool__(self):
+        """Return False if there are no rules to match."""
+        return self.data is not None or self.paths is not None or self.mime is not None
+
+    def match(self, item):
+        """Return True if 'item' of the output matches any rule.
+
+        Item is a tuple or a list (its first field is the matched key)
+        or a string.
+        """
+        if isinstance(item, (tuple, list)):
+            key = item[0]
+            mime = item[1] if len(item) > 1 else None
+        else:
+            key = item
+            mime = None
+        key = str(key)
+
+        if self.data is not None and self.data.search(key):
+            return True
+        if self.paths is not None and key.startswith("/") and self.paths.match(key):
+            return True
+        return self.mime is not None and isinstance(mime, str) and self.mime.search(mime) is not None
+
+    def apply(self, data):
+        """Return filtered list 'data'."""
+        if self.include:
+            return [item for item in data if self.match(item)]
+        return [item for item in data if not self.match(item)]
+
+def compile_filter(options):
+    """Return Filter object for filtering 'options' or None if they are
+    not valid.
+    """
+    try:
+        return Filter(options)
+    except ValueError as e:
+        logger.error("Filter: %s", e)
+        return None
+
+def load_filter(path):
+    """Load filtering options from JSON file 'path'.
+
+    Return dict {<key in the output>: <Filter or None>}.
+    """
+    with open(path) as fd:
+        options = json.load(fd)
+    return {key: compile_filter(value) for key, value in options.items()}
+
 def filter_output(data, options):
     """Filter an output of a module.
 
     'data' - data to filter (dict or list)
-    'option' - filtering options (see filter.json for example or
-               documentation of containerdiff)
+    'option' - filtering options (Filter object or dict, see Filter)
 
     Return value are filtered data. In case of any error it returns
     unmodified data.
     """
-    # Action key is mandatory
-    if not "action" in options or not isinstance(options["action"], str):
-        logger.error("Filter: wrong or missing \"action\" key in filter options")
-        return data
-    # Filtering options have to contain regular expressions to match
-    if not "data" in options or not isinstance(options["data"], list):
-        logger.error("Filter: wrong or missing \"data\" key in filter options")
+    if isinstance(options, dict):
+        options = compile_filter(options)
+    if options is None:
         return data
 
-    if "keys" in options:
+    if options.keys is not None:
         # Filter each specified key
         if not isinstance(data, dict):
             logger.error("Filter: \"keys\" filter option specified but filtered data is not dictionary")
             return data
-        for key in options["keys"]:
+        for key in options.keys:
             if not key in data:
                 logger.warning("Filter: in filtered data there is no key " + key)
                 break
-            data[key] = filter_output(data[key], {"action":options["action"], "data":options["data"]})
-    else:
-        if not isinstance(data, list):
-            logger.error("Filter: output of the module is not a list")
-            return data
-        if len(options["data"]) == 0:
-            logger.warning("Filter: \"data\" filter option is empty")
-            return data
-
-        # Check if item match any regular expression
-        pattern = re.compile("|".join(options["data"]))
-        # Do filtering of string representations of items
-        if options["action"] == "include":
-            data = list(filter(lambda item: pattern.search(str(item)), data))
-        elif options["action"] == "exclude":
-            data = list(filter(lambda item: not pattern.search(str(item)), data))
+            data[key] = filter_list(data[key], options)
+        return data
+    return filter_list(data, options)
 
-    return data
+def filter_list(data, options):
+    """Filter list 'data' by Filter 'options'. In case of any error it
+    returns unmodified data.
+    """
+    if not isinstance(data, list):
+        logger.error("Filter: output of the module is not a list")
+        return data
+    if not options:
+        logger.warning("Filter: filter options are empty")
+        return data
+    return options.apply(data)
@@ -0,0 +1,287 @@
+#   ContainerDiff - tool to show differences among container images
+#
+#   Copyright (C) 2016 Marek Skalicky mskalick@redhat.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with containerdiff.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Read images directly from the storage of docker graph driver.
+
+If containerdiff runs on the same host as the docker daemon and can
+read its storage, layers of images stored by overlay2 graph driver are
+read directly from their directories. So the image is not serialized to
+a tarball by docker API and extracted again (see undocker).
+
+Result of 'extract' is the same as the result of undocker.extract.
+"""
+
+import os
+import stat
+import hashlib
+import logging
+import tarfile
+import docker
+
+import containerdiff
+from containerdiff import budget
+from containerdiff import undocker
+
+logger = logging.getLogger(__name__)
+
+# Graph drivers which store layers as directories
+supported_drivers = ["overlay2"]
+
+# Extended attributes which mark opaque directories (user namespace is
+# used by rootless docker)
+opaque_xattrs = ["trusted.overlay.opaque", "user.overlay.opaque"]
+
+class NotAccessible(Exception):
+    """Layers of the image can't be read from graph driver storage."""
+
+def layer_directories(inspect):
+    """Return the list of directories with layers of image from the
+    bottom layer to the top one. 'inspect' is the result of
+    inspect_image.
+
+    Raises NotAccessible if the image is not stored by supported graph
+    driver or directories can't be read.
+    """
+    driver = inspect.get("GraphDriver") or {}
+    if driver.get("Name") not in supported_drivers:
+        raise NotAccessible("graph driver %s is not supported" % driver.get("Name"))
+    data = driver.get("Data") or {}
+    if not data.get("UpperDir"):
+        raise NotAccessible("missing UpperDir of the image")
+
+    # LowerDir lists layers from the top one
+    directories = []
+    if data.get("LowerDir"):
+        directories = list(reversed(data["LowerDir"].split(":")))
+    directories.append(data["UpperDir"])
+    for directory in directories:
+        if not os.access(directory, os.R_OK | os.X_OK):
+            raise NotAccessible("can't read directory " + directory)
+    return directories
+
+def is_whiteout(st):
+    """Return True if os.stat_result 'st' is overlay whiteout (character
+    device 0:0).
+    """
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+def is_opaque(path):
+    """Return True if directory 'path' is marked as opaque."""
+    for name in opaque_xattrs:
+        try:
+            if os.getxattr(path, name, follow_symlinks=False) == b"y":
+                return True
+        except OSError:
+            pass
+    return False
+
+def tar_type(st):
+    """Return tarfile type of file with os.stat_result 'st' or None for
+    files which are not stored in layers (sockets).
+    """
+    if stat.S_ISREG(st.st_mode):
+        return tarfile.REGTYPE
+    if stat.S_ISDIR(st.st_mode):
+        return tarfile.DIRTYPE
+    if stat.S_ISLNK(st.st_mode):
+        return tarfile.SYMTYPE
+    if stat.S_ISCHR(st.st_mode):
+        return tarfile.CHRTYPE
+    if stat.S_ISBLK(st.st_mode):
+        return tarfile.BLKTYPE
+    if stat.S_ISFIFO(st.st_mode):
+        return tarfile.FIFOTYPE
+    return None
+
+def file_info(path, st, file_type, linkname=""):
+    """Return dict with the same keys as tarfile.TarInfo.get_info for
+    file 'path' (relative to the layer directory) with os.stat_result
+    'st'. Values are the same as in layer archives created by docker
+    (user and group names are not set, checksum of tar header is 0).
+    """
+    name = path
+    if file_type == tarfile.DIRTYPE:
+        name += "/"
+    devmajor = devminor = 0
+    if file_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        devmajor = os.major(st.st_rdev)
+        devminor = os.minor(st.st_rdev)
+    size = st.st_size if file_type == tarfile.REGTYPE else 0
+    return {"name":name, "mode":stat.S_IMODE(st.st_mode), "uid":st.st_uid, "gid":st.st_gid,
+            "size":size, "mtime":int(st.st_mtime), "chksum":0, "type":file_type,
+            "linkname":linkname, "uname":"", "gname":"", "devmajor":devmajor, "devminor":devminor}
+
+def walk(directory, relative=""):
+    """Yield tuples (<path relative to 'directory'>, <os.DirEntry>) of
+    all files under 'directory'.
+
+    Files are yielded in the same order as docker writes them to layer
+    archives (sorted by name, each directory is followed by its
+    content), so hard links are detected the same way.
+    """
+    with os.scandir(os.path.join(directory, relative)) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    for entry in entries:
+        path = os.path.join(relative, entry.name)
+        yield path, entry
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(directory, path)
+
+def copy_regular(source, target, store=None):
+    """Create file 'target' with the content of file 'source' from
+    layer directory. Content is copied through content addressed
+    'store' if it is specified (see undocker.store_content).
+
+    Returns sha256 digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(source, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(undocker.block_size), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+
+    if store is None:
+        undocker.copy_file(source, target)
+    else:
+        stored = undocker.store_content(store, digest, lambda path: undocker.copy_file(source, path))
+        undocker.clone_file(stored, target)
+    return digest
+
+def extract_layer(directory, output, metadata, whiteouts=True, scope=None, store=None):
+    """Copy layer stored in 'directory' to folder 'output' and update
+    'metadata' (see undocker.extract_layer).
+
+    Overlay whiteouts (character devices 0:0) remove files of lower
+    layers, opaque directories (see 'opaque_xattrs') hide the content of
+    lower layers.
+    """
+    # Paths of first hard links to inodes {(<device>, <inode>): <path>}
+    links = {}
+    for path, entry in walk(directory):
+        st = entry.stat(follow_symlinks=False)
+        target = os.path.join(output, path)
+        file_type = tar_type(st)
+
+        if whiteouts:
+            if is_whiteout(st):
+                logger.debug('Removing path /%s', path)
+                undocker.remove_path(target)
+                undocker.remove_subtrees(metadata, ['/'+path])
+                continue
+            if file_type == tarfile.DIRTYPE and is_opaque(entry.path):
+                logger.debug('Removing content of /%s', path)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    for child in os.listdir(target):
+                        undocker.remove_path(os.path.join(target, child))
+                undocker.remove_subtrees(metadata, ['/'+path], keep=True)
+
+        if file_type is None:
+            continue
+        linkname = ""
+        if file_type == tarfile.SYMTYPE:
+            linkname = os.readlink(entry.path)
+        elif file_type == tarfile.REGTYPE and st.st_nlink > 1:
+            inode = (st.st_dev, st.st_ino)
+            if inode in links:
+                file_type = tarfile.LNKTYPE
+                linkname = links[inode]
+            else:
+                links[inode] = path
+
+        # Symbolic links are always extracted (see undocker.extract_layer)
+        in_scope = scope is None or '/'+path in scope
+        if not in_scope and file_type != tarfile.SYMTYPE:
+            continue
+        info = file_info(path, st, file_type, linkname)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if file_type == tarfile.DIRTYPE:
+            if not os.path.isdir(target) or os.path.islink(target):
+                undocker.remove_path(target)
+                os.mkdir(target)
+        elif file_type in (tarfile.BLKTYPE, tarfile.CHRTYPE):
+            # Device files are not extracted
+            undocker.remove_path(target)
+        else:
+            undocker.remove_path(target)
+            if file_type == tarfile.REGTYPE:
+                info['digest'] = copy_regular(entry.path, target, store)
+            elif file_type == tarfile.SYMTYPE:
+                os.symlink(linkname, target)
+            elif file_type == tarfile.LNKTYPE:
+                source = metadata.get('/'+linkname, {})
+                source_path = os.path.join(output, linkname)
+                if 'digest' in source and os.path.lexists(source_path):
+                    info['digest'] = source['digest']
+                    os.link(source_path, target, follow_symlinks=False)
+                else:
+                    # Target of the link can be outside of the scope
+                    info['digest'] = copy_regular(entry.path, target, store)
+            elif file_type == tarfile.FIFOTYPE:
+                os.mkfifo(target)
+
+        if in_scope:
+            metadata['/'+path] = info
+
+def extract(ID, output, one_layer=False, whiteouts=True, scope=None, store=None):
+    """Extract the content of image *ID* to folder *output* from layer
+    directories of the graph driver (see 'layer_directories').
+
+    Arguments and the result are the same as for undocker.extract. If
+    layers can't be read from the graph driver storage, the image is
+    extracted by undocker.extract.
+    """
+    cli = docker.AutoVersionClient(base_url = containerdiff.docker_socket)
+    try:
+        inspect = cli.inspect_image(ID)
+    except docker.errors.NotFound:
+        logger.critical("Can't find image %s", ID)
+        raise
+    ID = inspect['Id']
+
+    try:
+        directories = layer_directories(inspect)
+    except NotAccessible as e:
+        logger.warning("Can't read image %s from graph driver storage (%s), using docker save", ID, e)
+        return undocker.extract(ID, output, one_layer, whiteouts, scope, store)
+    if one_layer:
+        directories = directories[-1:]
+
+    budget.check('extraction of image %s' % ID)
+    logger.info('Extracting image %s from graph driver storage', ID)
+    if not os.path.isdir(output):
+        os.mkdir(output)
+    if store is not None:
+        os.makedirs(store, exist_ok=True)
+
+    metadata = {}
+    try:
+        for directory in directories:
+            budget.check('extraction of layer %s' % directory)
+            logger.info('Extracting layer %s', directory)
+            extract_layer(directory, output, metadata, whiteouts, scope, store)
+            logger.debug('Actual metadata size - %i', len(metadata))
+    except PermissionError as e:
+        logger.warning("Can't read image %s from graph driver storage (%s), using docker save", ID, e)
+        undocker.remove_path(output)
+        return undocker.extract(ID, output, one_layer, whiteouts, scope, store)
+
+    logger.info('Computing tree digests of image %s', ID)
+    undocker.tree_digests(metadata)
+
+    return metadata
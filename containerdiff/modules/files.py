@@ -19,36 +19,89 @@
 """Show diff in container image files."""
 
 import os
+import mmap
 import difflib
 import logging
 import magic
 import logging
 import tarfile
 
+from contextlib import closing
+
 import containerdiff
 import containerdiff.package_managers
+from containerdiff import undocker
+from containerdiff import budget
 
 logger = logging.getLogger(__name__)
 
+# Order of the module in containerdiff run (cheap tests first)
+priority = 40
+# Module needs extracted images
+needs_extraction = True
+
 # Contains the object of package manager class
 package_manager = containerdiff.package_managers.RPM()
 
+# Size of blocks compared in files_equal
+chunk_size = 1024*1024
+
+# Maximal size of files compared line by line when the time budget is
+# set (difflib can not be interrupted)
+budget_diff_size = 256*1024
+
+def files_equal(file1, file2):
+    """Return True if two files have the same content.
+
+    Files are memory mapped and compared by blocks of 'chunk_size'
+    bytes until the first difference, so the memory usage does not
+    depend on the size of files.
+    """
+    size = os.path.getsize(file1)
+    if size != os.path.getsize(file2):
+        return False
+    if size == 0 or os.path.samefile(file1, file2):
+        return True
+
+    with open(file1, "rb") as fd1, open(file2, "rb") as fd2, \
+            closing(mmap.mmap(fd1.fileno(), 0, access=mmap.ACCESS_READ)) as map1, \
+            closing(mmap.mmap(fd2.fileno(), 0, access=mmap.ACCESS_READ)) as map2:
+        for offset in range(0, size, chunk_size):
+            if map1[offset:offset+chunk_size] != map2[offset:offset+chunk_size]:
+                return False
+    return True
+
 def files_diff(filepath, dirpath1, dirpath2):
     """Return the diff of file specified by absolute path in two
     chroots specified by two root directories.
 
-    Returns unified diff of the file.
+    Returns unified diff of the file. Only files which differ and are
+    not bigger than containerdiff.max_diff_size bytes (or
+    'budget_diff_size' bytes if the time budget is set) are compared by
+    lines. For other files which differ (or binary files) a one line
+    message is returned.
+
+    Raises budget.TimeBudgetExceeded if the time budget is exceeded
+    before the files are compared by lines.
     """
     file1 = os.path.normpath(os.sep.join([dirpath1,filepath]))
     file2 = os.path.normpath(os.sep.join([dirpath2,filepath]))
     diff = []
     if os.path.isfile(file1) and os.path.isfile(file2):
+        if files_equal(file1, file2):
+            return diff
+        max_size = containerdiff.max_diff_size
+        if budget.remaining() is not None:
+            max_size = min(max_size, budget_diff_size)
+        if max(os.path.getsize(file1), os.path.getsize(file2)) > max_size:
+            return ["Files "+file1+" and "+file2+" differ"]
+        budget.check("diff of file "+filepath)
         try:
             with open(file1, "r") as fd1, open(file2, "r") as fd2:
                 diff = list(difflib.unified_diff(fd1.read().splitlines(), fd2.read().splitlines(), fromfile=file1, tofile=file2, lineterm=""))
         except UnicodeDecodeError:
             # To handle error for non-text file
-            pass
+            diff = ["Binary files "+file1+" and "+file2+" differ"]
 
     return diff
 
@@ -60,8 +113,9 @@ def metadata_diff(filepath, metadata1, metadata2):
     """
     # Find tuples (property, value) in metadata which are not same
     diff = set(metadata1[filepath].items()) ^ set(metadata2[filepath].items())
-    # Only tuples ("mtime",...) and ("chksum",...) can be different in file metadata
-    diff = list(filter(lambda x: x[0] != "mtime" and x[0] != "chksum", diff))
+    # Only tuples ("mtime",...) and ("chksum",...) can be different in
+    # file metadata. Digests are compared by changed_paths and files_diff.
+    diff = list(filter(lambda x: x[0] not in ("mtime", "chksum", "digest", "tree_digest"), diff))
 
     result = {}
     for key in diff:
@@ -73,6 +127,46 @@ def metadata_diff(filepath, metadata1, metadata2):
 
     return result
 
+def changed_paths(metadata1, metadata2):
+    """Return the set of paths which are not same in both images.
+
+    The file trees are compared from "/" using "tree_digest" of files
+    (see undocker.tree_digests). Subtrees with the same digest are
+    skipped, so only directories which contain some change are
+    examined. Result contains changed files and directories which
+    contain changed files (their own metadata may be unchanged).
+    """
+    children1 = undocker.build_tree(metadata1)
+    children2 = undocker.build_tree(metadata2)
+
+    result = set()
+    directories = ["/"]
+    while directories:
+        directory = directories.pop()
+        for path in children1.get(directory, set()) | children2.get(directory, set()):
+            digest1 = metadata1.get(path, {}).get("tree_digest")
+            digest2 = metadata2.get(path, {}).get("tree_digest")
+            if digest1 is not None and digest1 == digest2:
+                continue
+            result.add(path)
+            if path in children1 or path in children2:
+                directories.append(path)
+    return result
+
+def summarize(added, removed, modified, depth):
+    """Return the count of changed files in directories.
+
+    Paths of changes are grouped by first 'depth' components of their
+    directory. Result is a sorted list of tuples (<directory>,
+    <added count>, <removed count>, <modified count>).
+    """
+    counts = {}
+    for index, paths in enumerate([added, removed, modified]):
+        for path in paths:
+            directory = os.sep.join(os.path.dirname(path).split(os.sep)[:depth+1]) or os.sep
+            counts.setdefault(directory, [0, 0, 0])[index] += 1
+    return [tuple([directory]+count) for directory, count in sorted(counts.items())]
+
 def device_mime(tar_type):
     """Return string representation of MIME from tarfile.type"""
     if tar_type == tarfile.BLKTYPE:
@@ -82,6 +176,16 @@ def device_mime(tar_type):
     elif tar_type == tarfile.FIFOTYPE:
         return "inode/fifo; charset=binary"
 
+def file_mime(mime_loader, filepath, metadata, output_dir):
+    """Return MIME of file 'filepath' from image extracted to
+    'output_dir'. Returns None if the time budget is exceeded.
+    """
+    if metadata[filepath]["type"] in [tarfile.BLKTYPE, tarfile.CHRTYPE, tarfile.FIFOTYPE]:
+        return device_mime(metadata[filepath]["type"])
+    if budget.exceeded():
+        return None
+    return mime_loader.file(os.path.normpath(os.sep.join([output_dir,filepath])))
+
 def test_unowned_files(ID1, output_dir1, metadata1, ID2, output_dir2, metadata2):
     """Test changes in files that are not installed by package manager.
 
@@ -92,53 +196,120 @@ def test_unowned_files(ID1, output_dir1, metadata1, ID2, output_dir2, metadata2)
       (file_path, file_type, file_diff, file_metadatadiff)
 
     In silent mode, key "modified" contains only file paths and file types.
+
+    If the time budget is exceeded, file types are None and files which
+    were not compared (or their types were not detected) are listed in
+    additional key "not_compared".
+
+    Only files from subtrees which differ (see "changed_paths") are
+    tested for modification.
+
+    If containerdiff.summary_depth is set, result is a dict {"summary":..}
+    containing counts of changed files in directories (see "summarize").
     """
+    # Sets of unowned files are computed once for each image and shared
+    # by all loops below
     unowned_files1 = package_manager.get_unowned_files(ID1, metadata1, output_dir1)
     unowned_files2 = package_manager.get_unowned_files(ID2, metadata2, output_dir2)
+    added_files = sorted(unowned_files2 - unowned_files1)
+    removed_files = sorted(unowned_files1 - unowned_files2)
+
+    changed = changed_paths(metadata1, metadata2)
+    logger.debug("%i paths in changed subtrees", len(changed))
+    # Paths which are not changed are not compared at all
+    changed_files = changed.intersection(unowned_files1, unowned_files2)
+
+    if containerdiff.summary_depth:
+        modified = [filepath for filepath in changed_files \
+                    if metadata2[filepath]["type"] != tarfile.DIRTYPE \
+                    or len(metadata_diff(filepath, metadata1, metadata2)) != 0]
+        return {"summary":summarize(added_files, removed_files, modified, containerdiff.summary_depth)}
 
     mime_loader = magic.open(magic.MAGIC_MIME)
     mime_loader.load()
 
+    not_compared = []
     added = []
-    for filepath in (set(unowned_files2)-set(unowned_files1)):
-        if metadata2[filepath]["type"] in  [tarfile.BLKTYPE, tarfile.CHRTYPE, tarfile.FIFOTYPE]:
-            mime = device_mime(metadata2[filepath]["type"])
-        else:
-            mime = mime_loader.file(os.path.normpath(os.sep.join([output_dir2,filepath])))
+    for filepath in added_files:
+        mime = file_mime(mime_loader, filepath, metadata2, output_dir2)
+        if mime is None:
+            not_compared.append(filepath)
         added.append((filepath, mime))
     removed = []
-    for filepath in (set(unowned_files1)-set(unowned_files2)):
-        if metadata1[filepath]["type"] in  [tarfile.BLKTYPE, tarfile.CHRTYPE, tarfile.FIFOTYPE]:
-            mime = device_mime(metadata1[filepath]["type"])
-        else:
-            mime = mime_loader.file(os.path.normpath(os.sep.join([output_dir1,filepath])))
+    for filepath in removed_files:
+        mime = file_mime(mime_loader, filepath, metadata1, output_dir1)
+        if mime is None:
+            not_compared.append(filepath)
         removed.append((filepath, mime))
     modified = []
-    for filepath in (set(unowned_files1).intersection(set(unowned_files2))):
+    # Compare small files first to compare as many files as possible in
+    # the time budget
+    for filepath in sorted(changed_files, key=lambda filepath: metadata2[filepath]["size"]):
+        if budget.exceeded():
+            not_compared.append(filepath)
+            continue
         metadata = metadata_diff(filepath, metadata1, metadata2)
-        diff = files_diff(filepath, output_dir1, output_dir2)
-        if metadata2[filepath]["type"] in  [tarfile.BLKTYPE, tarfile.CHRTYPE, tarfile.FIFOTYPE]:
-            mime_new = device_mime(metadata2[filepath]["type"])
-        else:
-            mime_new = mime_loader.file(os.path.normpath(os.sep.join([output_dir2,filepath])))
+        try:
+            diff = files_diff(filepath, output_dir1, output_dir2)
+        except budget.TimeBudgetExceeded:
+            not_compared.append(filepath)
+            continue
+        if len(diff) == 0 and len(metadata) == 0:
+            continue
+        mime_new = file_mime(mime_loader, filepath, metadata2, output_dir2)
+        if mime_new is None:
+            not_compared.append(filepath)
 
         if containerdiff.silent:
-            if len(diff) != 0 or len(metadata) != 0:
-                modified.append((filepath, mime_new))
+            modified.append((filepath, mime_new))
         else:
-            if len(diff) != 0 or len(metadata) != 0:
-                modified.append((filepath, mime_new, diff, metadata))
+            modified.append((filepath, mime_new, diff, metadata))
 
+    if not_compared:
+        logger.warning("%i files were not fully compared in the time budget", len(not_compared))
+        return {"added":added, "removed":removed, "modified":modified, "not_compared":not_compared}
     return {"added":added, "removed":removed, "modified":modified}
 
 
 
+def test_owned_files(ID1, output_dir1, metadata1, ID2, output_dir2, metadata2):
+    """Test files installed by package manager which differ from the
+    files in packages (see verify_files of package manager).
+
+    Result is a list of tuples (file_path, changes) for files which
+    differ from the package in the second image and do not differ in
+    the same way in the first image. So files modified the same way in
+    both images are not listed. 'changes' is a dict {<property>:
+    (<value in package>, <value in image>)}.
+
+    In silent mode, list contains only file paths.
+    """
+    modified1 = dict(package_manager.verify_files(ID1, metadata1, output_dir1))
+    result = []
+    for filepath, changes in package_manager.verify_files(ID2, metadata2, output_dir2):
+        if modified1.get(filepath) == changes:
+            continue
+        if containerdiff.silent:
+            result.append(filepath)
+        else:
+            result.append((filepath, changes))
+    return result
+
+def empty_result():
+    """Return the output of the module for images with the same layers."""
+    if containerdiff.summary_depth:
+        return {"files":{"summary":[]}}
+    return {"files":{"added":[], "removed":[], "modified":[], "owned_modified":[]}}
+
 def run(image1, image2):
     """Test files in the image.
 
     Adds one key to the output of the diff tool:
     "files" - dict containing information about changed files (see
-              output of "test_files" function in this module)
+              output of "test_unowned_files" function in this module).
+              Key "owned_modified" contains files installed by package
+              manager which differ from packages (see output of
+              "test_owned_files" function in this module).
     """
     ID1, metadata1, output_dir1 = image1
     ID2, metadata2, output_dir2 = image2
@@ -147,4 +318,6 @@ def run(image1, image2):
 
     result = {}
     result["files"] = test_unowned_files(ID1, output_dir1, metadata1, ID2, output_dir2, metadata2)
+    if not containerdiff.summary_depth:
+        result["files"]["owned_modified"] = test_owned_files(ID1, output_dir1, metadata1, ID2, output_dir2, metadata2)
     return result
@@ -26,6 +26,9 @@ import containerdiff
 
 logger = logging.getLogger(__name__)
 
+# Order of the module in containerdiff run (cheap tests first)
+priority = 20
+
 def dockerfile_from_image(ID, cli):
     """Return list of commands used to create image 'ID'. These
     commands is an output from docker history.
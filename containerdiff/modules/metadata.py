@@ -19,48 +19,119 @@
 """Show diff of container image metadata."""
 
 import docker
-import difflib
 import logging
 
 import containerdiff
 
 logger = logging.getLogger(__name__)
 
-def expand_dict(data, path=""):
-    """Expand Python dict or list object (which replresents JSON
-    object) into list. Every element of list is a string and it has two
-    logical parts divided by " = ". So every list element has this
-    form: "<path> = <value>".
-
-    <path> consists of strings joined together by ":" . Each part of
-    this <path> tells where to find the <value> in Python dict. After
-    expanding a list every value in the list has the same prefix.
-
-    <value> is string, number, bool or None.
-
-
-    For example this dict {"foo":1, "bar":{"a":2, "b":["x=1", "y=2"]}}
-    results to ["foo = 1", "bar:a = 2", "bar:b = x=1", "bar:b = y=2"].
-
-    expand_dict also takes second parameter path. This parameter is by
-    default "", but can be set to add some prefix to elements of result
-    list.
-
-    Returns list of strings.
+# Order of the module in containerdiff run (cheap tests first)
+priority = 10
+
+# Paths of `docker inspect` fields which differ for every build of an
+# image. They are skipped when containerdiff.ignore_volatile is set.
+volatile_paths = ["Id", "Created", "Container", "Parent", "Size",
+                  "VirtualSize", "RepoTags", "RepoDigests",
+                  "Config:Hostname", "Config:Image",
+                  "ContainerConfig:Hostname", "ContainerConfig:Image",
+                  "Metadata:LastTagTime"]
+
+def env_identity(item):
+    """Return the name of an environment variable from "NAME=value"."""
+    return str(item).split("=", 1)[0]
+
+def value_identity(item):
+    """Return the item itself, so the list is compared like a set."""
+    return str(item)
+
+# Lists which are not compared by index of elements. Key is a path to
+# the list and value is a function returning an identity of an element.
+list_identities = {
+    "Config:Env": env_identity,
+    "ContainerConfig:Env": env_identity,
+    "RepoTags": value_identity,
+    "RepoDigests": value_identity,
+}
+
+def join_path(path, key):
+    """Return <path> extended by dict key 'key'."""
+    if path:
+        return path+":"+str(key)
+    return str(key)
+
+def keyed_list(data, identity):
+    """Return dict {<identity>: <element>} made from list 'data'.
+
+    If two elements have the same identity None is returned, so the
+    list has to be compared by index.
+    """
+    result = {}
+    for item in data:
+        key = identity(item)
+        if key in result:
+            return None
+        result[key] = item
+    return result
+
+def diff_structures(old, new, path="", ignore=(), result=None):
+    """Compare two Python objects which represent JSON documents.
+
+    Dicts are compared by keys. Lists are compared by index of elements
+    or by identity of elements if there is a function for the <path>
+    of the list in 'list_identities'. Every value is visited only once,
+    so run time is linear in the size of the documents.
+
+    <path> of a value consists of dict keys joined together by ":" .
+    Elements of lists have "[<index or identity>]" suffix, for example
+    "Config:Env[PATH]" or "Config:Cmd[0]". Values with <path> in 'ignore'
+    are not compared.
+
+    Result is a dict {"added":.., "removed":.., "modified":..}. First two
+    keys contain tuples (<path>, <value>), key "modified" contains tuples
+    (<path>, <old_value>, <new_value>). If 'result' is specified the
+    changes are appended to it.
     """
-    if isinstance(data, list):
-        result = []
-        for item in data:
-            result.extend(expand_dict(item, path))
+    if result is None:
+        result = {"added":[], "removed":[], "modified":[]}
+    if path in ignore:
         return result
 
-    if isinstance(data, dict):
-        result = []
-        for item in data:
-            result.extend(expand_dict(data[item], path+item+":"))
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            item_path = join_path(path, key)
+            if key in new:
+                diff_structures(old[key], new[key], item_path, ignore, result)
+            elif item_path not in ignore:
+                result["removed"].append((item_path, old[key]))
+        for key in new:
+            item_path = join_path(path, key)
+            if key not in old and item_path not in ignore:
+                result["added"].append((item_path, new[key]))
         return result
 
-    return [path[:-1]+" = "+str(data)]
+    if isinstance(old, list) and isinstance(new, list):
+        keyed_old = keyed_new = None
+        if path in list_identities:
+            keyed_old = keyed_list(old, list_identities[path])
+            keyed_new = keyed_list(new, list_identities[path])
+        if keyed_old is None or keyed_new is None:
+            # Compare by index
+            keyed_old = dict(enumerate(old))
+            keyed_new = dict(enumerate(new))
+        for key in keyed_old:
+            item_path = path+"["+str(key)+"]"
+            if key in keyed_new:
+                diff_structures(keyed_old[key], keyed_new[key], item_path, ignore, result)
+            else:
+                result["removed"].append((item_path, keyed_old[key]))
+        for key in keyed_new:
+            if key not in keyed_old:
+                result["added"].append((path+"["+str(key)+"]", keyed_new[key]))
+        return result
+
+    if type(old) is not type(new) or old != new:
+        result["modified"].append((path, old, new))
+    return result
 
 
 def test_metadata(ID1, ID2, old, new):
@@ -71,24 +142,24 @@ def test_metadata(ID1, ID2, old, new):
     'old' - metadata of files from first image
     'new' - metadata of files from second image
 
-    Expands the metadata from `docker inspect` to the list of strings
-    (see ouput of "expand_dict" function in this module). Returns
-    unified_diff of these strings.
+    Does structural diff of the metadata from `docker inspect` (see
+    output of "diff_structures" function in this module). In case
+    containerdiff.ignore_volatile is set, fields from 'volatile_paths'
+    are not compared.
     """
-    expanded_old = expand_dict(old)
-    expanded_new = expand_dict(new)
-
-    diff = [item for item in difflib.unified_diff(expanded_old, expanded_new, n=0) if not item.startswith(("+++","---","@@"))]
+    ignore = ()
+    if containerdiff.ignore_volatile:
+        ignore = frozenset(volatile_paths)
 
-    return list(diff)
+    return diff_structures(old, new, ignore=ignore)
 
 
 def run(image1, image2):
     """Test metadata of the image.
 
     Adds one key to the output of the diff tool:
-    "metadata" - unified_diff style changes in metadata (see output of
-                "test_metadata" function in this module)
+    "metadata" - dict containing information about changed metadata (see
+                 output of "test_metadata" function in this module)
     """
     ID1, metadata1, output_dir1 = image1
     ID2, metadata2, output_dir2 = image2
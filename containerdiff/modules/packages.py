@@ -28,6 +28,9 @@ import containerdiff.package_managers
 
 logger = logging.getLogger(__name__)
 
+# Order of the module in containerdiff run (cheap tests first)
+priority = 30
+
 # Contains the object of package manager class
 package_manager = containerdiff.package_managers.RPM()
 
@@ -56,6 +59,10 @@ def test_packages(ID1, ID2):
 
 
 
+def empty_result():
+    """Return the output of the module for images with the same layers."""
+    return {"packages":{"added":[], "removed":[], "modified":[]}}
+
 def run(image1, image2):
     """Test packages in the image.
 
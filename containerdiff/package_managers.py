@@ -21,16 +21,20 @@
 It is also possible to add support to another package mangers. To be
 able to use tests in modules with the new package manager it is
 necessary to implement it as a class which provides functions:
-get_installed_packages and get_unowned_files .
+get_installed_packages, get_unowned_files and verify_files .
 """
 
 import docker
+import requests
 import tempfile
 import os
+import hashlib
+import tarfile
 import shutil
 import logging
 
 import containerdiff
+from containerdiff import budget
 
 logger = logging.getLogger(__name__)
 
@@ -38,8 +42,15 @@ def get_output_from_container(image, command):
     """Run 'command' in shell in container based on 'image'. Get its
     output by redirecting STDOUT to mounted file.
 
-    Return list o lines from the 'command' output.
+    Yield lines from the 'command' output (without the trailing
+    newline). The output file is read line by line, so the whole output
+    is never stored in memory. The container is run when the first line
+    is requested and removed when the generator is exhausted or closed.
+
+    Raises budget.TimeBudgetExceeded if the command does not finish in
+    the time budget.
     """
+    budget.check("command '"+command+"'")
     logger.info("Running '%s' in image '%s'", command, image)
     cli = docker.AutoVersionClient(base_url = containerdiff.docker_socket)
 
@@ -51,32 +62,65 @@ def get_output_from_container(image, command):
             command="/bin/sh -c 'set -m; touch /mnt/containerdiff-volume/output; chmod a+rw /mnt/containerdiff-volume/output; exec 1>/mnt/containerdiff-volume/output; "+command+"'",
             user=os.geteuid())
 
-    cli.start(container);
-    error = cli.logs(container)
-    if error != b'':
-        logger.error(error)
+    try:
+        cli.start(container)
+        # Time budget can be exceeded while the container is starting
+        # (zero timeout is not accepted by requests)
+        timeout = budget.remaining()
+        if timeout is not None and timeout <= 0:
+            raise budget.TimeBudgetExceeded("Command '"+command+"' was not finished in the time budget")
+        try:
+            cli.wait(container, timeout=timeout)
+        except requests.exceptions.RequestException:
+            if budget.exceeded():
+                raise budget.TimeBudgetExceeded("Command '"+command+"' was not finished in the time budget")
+            raise
+        error = cli.logs(container)
+        if error != b'':
+            logger.error(error)
+
+        with open(os.path.join(volume_dir, "output")) as output:
+            for line in output:
+                yield line.rstrip("\n")
+    finally:
+        if budget.exceeded():
+            # Do not wait for the grace period (10 seconds by default)
+            cli.stop(container, timeout=0)
+        else:
+            cli.stop(container)
+        cli.remove_container(container)
+        shutil.rmtree(volume_dir, ignore_errors=True)
 
-    cli.stop(container)
-    cli.remove_container(container)
 
-    output = open(os.path.join(volume_dir, "output")).read()
+class RPM:
+    """This class represents RPM package manager."""
 
-    shutil.rmtree(volume_dir, ignore_errors=True)
+    # Query printing attributes of files installed by rpms. One line per
+    # file: path, size, mode (octal), digest and flags separated by tabs.
+    file_query = "rpm -qa --qf \"[%{FILENAMES}\\t%{FILESIZES}\\t%{FILEMODES:octal}\\t%{FILEDIGESTS}\\t%{FILEFLAGS:fflags}\\n]\""
 
-    return output
+    # Hash algorithms of rpm file digests by the length of hex digest
+    digest_algorithms = {32:"md5", 40:"sha1", 56:"sha224", 64:"sha256", 96:"sha384", 128:"sha512"}
 
+    def __init__(self):
+        # Cache of _get_file_attributes results
+        self._file_attributes = {}
+        # Cache of get_unowned_files results
+        self._unowned_files = {}
 
-class RPM:
-    """This class represents RPM package manager."""
+    def _get_file_attributes(self, ID, root):
+        """Get attributes of files installed by rpms in image 'ID' which
+        is expanded into 'root'. It runs rpm query in the image and
+        removes symbolic links in directories in the result.
 
-    def _get_owned_files(self, ID, root):
-        """Get list files installed by rpms in image 'ID' which is
-        expanded into 'root'. It runs "rpm -qal" command in the image
-        and removes symbolic links in directories in the result.
+        Returns dict {<path>: (<size>, <mode>, <digest>, <flags>)}. The
+        result is cached, so the query runs only once for each image.
+
+        If containerdiff.path_scope is set, only files in the scope are
+        returned.
         """
-        # Some RPM package does not contain file, so rpm prints
-        # "(contains no files)" string.
-        filelist = get_output_from_container(ID, "rpm -qal | grep -v \(contains\ no\ files\)").split("\n")
+        if (ID, root) in self._file_attributes:
+            return self._file_attributes[(ID, root)]
 
         # Do not use directory symlinks in paths.
         # Some packages for example say that own files in /lib and some
@@ -86,27 +130,97 @@ class RPM:
         # list store only path without symbolic links for easier
         # comparison.
 
-        filelist = [os.sep.join(["",os.path.relpath(os.path.realpath(os.sep.join([root, os.path.dirname(filepath)])), start=root), os.path.basename(filepath)]) \
-                        for filepath in filelist]
-        return filelist
+        # Directories are resolved only once.
+        real_dirs = {}
+        result = {}
+        for line in get_output_from_container(ID, self.file_query):
+            fields = line.split("\t")
+            if len(fields) != 5:
+                continue
+            filepath, size, mode, digest, flags = fields
+            dirname = os.path.dirname(filepath)
+            if dirname not in real_dirs:
+                real_dirs[dirname] = os.sep.join(["",os.path.relpath(os.path.realpath(os.sep.join([root, dirname])), start=root)])
+            filepath = os.path.normpath(os.sep.join([real_dirs[dirname], os.path.basename(filepath)]))
+            # Files outside of the scope are not extracted
+            if containerdiff.path_scope is None or filepath in containerdiff.path_scope:
+                # More packages can own the same file
+                result.setdefault(filepath, (int(size), int(mode, 8), digest, flags))
+
+        self._file_attributes[(ID, root)] = result
+        return result
+
+    def _get_owned_files(self, ID, root):
+        """Get set-like view of files installed by rpms in image 'ID'
+        which is expanded into 'root' (see _get_file_attributes).
+        """
+        return self._get_file_attributes(ID, root).keys()
 
     def get_unowned_files(self, ID, metadata, root):
-        """Return the list of files that are listed in 'metadata' dict
-        (result from extracting the image) and are not installed by
+        """Return the frozenset of files that are listed in 'metadata'
+        dict (result from extracting the image) and are not installed by
         rpm packages in image 'ID'.
-        """
 
-        owned_files = self._get_owned_files(ID, root)
-        return list(set(metadata.keys())-set(owned_files))
+        The result is cached, so it is computed only once for each
+        image and can be shared by all tests.
+        """
+        if (ID, root) not in self._unowned_files:
+            self._unowned_files[(ID, root)] = frozenset(metadata.keys() - self._get_owned_files(ID, root))
+        return self._unowned_files[(ID, root)]
+
+    def verify_files(self, ID, metadata, root):
+        """Return the list of regular files installed by rpm packages in
+        image 'ID' which differ from the files in packages.
+
+        Size and permissions from rpm database are compared with
+        'metadata' (result from extracting the image). Digest is
+        compared only for files with the same size. sha256 digests are
+        taken from 'metadata', files with other digest algorithms are
+        read from 'root' (unless the time budget is exceeded). Ghost
+        files are not verified.
+
+        Each element of the list is a tuple (<path>, <changes>).
+        <changes> is a dict with keys "size", "mode" or "digest" and
+        values (<value in package>, <value in image>).
+        """
+        result = []
+        for filepath, (size, mode, digest, flags) in sorted(self._get_file_attributes(ID, root).items()):
+            info = metadata.get(filepath)
+            if info is None or "digest" not in info or not digest or "g" in flags:
+                continue
+
+            changes = {}
+            if info["type"] != tarfile.LNKTYPE and size != info["size"]:
+                changes["size"] = (size, info["size"])
+            if mode & 0o7777 != info["mode"]:
+                changes["mode"] = (mode & 0o7777, info["mode"])
+            if "size" not in changes:
+                algorithm = self.digest_algorithms.get(len(digest))
+                file_digest = None
+                if algorithm == "sha256":
+                    file_digest = info["digest"]
+                elif algorithm is not None and not budget.exceeded():
+                    file_digest = hashlib.new(algorithm)
+                    with open(os.path.normpath(os.sep.join([root, filepath])), "rb") as fd:
+                        for chunk in iter(lambda: fd.read(1024*1024), b""):
+                            file_digest.update(chunk)
+                    file_digest = file_digest.hexdigest()
+                if file_digest is not None and file_digest != digest:
+                    changes["digest"] = (digest, file_digest)
+
+            if changes:
+                result.append((filepath, changes))
+        return result
 
     def get_installed_packages(self, ID):
         """Return list of installed packages in image 'ID'. Each
         element of the list is a tuple (<package name>, <version>).
         """
-        packages = get_output_from_container(ID, "rpm -qa").split()
-
         name_version = []
-        for package in packages:
+        for package in get_output_from_container(ID, "rpm -qa"):
+            package = package.strip()
+            if not package:
+                continue
             elements = package.split("-")
             name_version.append(("-".join(elements[:-2]), "-".join(elements[-2:])))
         return name_version
@@ -0,0 +1,131 @@
+#   ContainerDiff - tool to show differences among container images
+#
+#   Copyright (C) 2016 Marek Skalicky mskalick@redhat.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with containerdiff.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Restrict containerdiff to a part of the file tree."""
+
+import os
+import re
+
+def is_glob(pattern):
+    """Return True if 'pattern' contains shell wildcards."""
+    return any(char in pattern for char in "*?[")
+
+def translate(pattern):
+    """Return regular expression (without anchors) for shell glob
+    'pattern'. Unlike fnmatch.translate, wildcards ("*", "?" and
+    "[...]") do not match "/".
+    """
+    result = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+        if char == "*":
+            result.append("[^/]*")
+        elif char == "?":
+            result.append("[^/]")
+        elif char == "[":
+            end = index
+            if end < len(pattern) and pattern[end] == "!":
+                end += 1
+            if end < len(pattern) and pattern[end] == "]":
+                end += 1
+            end = pattern.find("]", end)
+            if end == -1:
+                result.append("\\[")
+                continue
+            chars = pattern[index:end].replace("\\", "\\\\").replace("[", "\\[")
+            index = end + 1
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            # Character class does not match "/" either
+            result.append("(?!/)[" + chars + "]")
+        else:
+            result.append(re.escape(char))
+    return "".join(result)
+
+class PathMatcher:
+    """Match paths against a set of patterns.
+
+    Pattern is a path prefix (e.g. "/etc" matches "/etc" and every path
+    under "/etc") or shell glob (e.g. "/opt/*/conf"). Wildcards do not
+    match "/" (see 'translate'). Glob matches also paths under matching
+    directories.
+
+    Prefixes are stored in a trie of path components, so the time of
+    matching depends on the depth of the path and not on the number of
+    prefixes. All globs are compiled into one regular expression.
+    """
+
+    def __init__(self, patterns=()):
+        # Nested dicts {<path component>: <subtrie>}, key None marks
+        # the end of a prefix
+        self.trie = {}
+        self.regex = None
+
+        globs = []
+        for pattern in patterns:
+            pattern = os.path.normpath("/"+pattern.strip("/"))
+            if is_glob(pattern):
+                globs.append(translate(pattern))
+                continue
+            node = self.trie
+            for component in pattern.split("/"):
+                if component:
+                    node = node.setdefault(component, {})
+            node[None] = True
+        if globs:
+            # Paths under matching directories match too
+            self.regex = re.compile("(?s:(?:%s)(?:/.*)?)\\Z" % "|".join(globs))
+
+    def __bool__(self):
+        """Return False if there are no patterns."""
+        return bool(self.trie) or self.regex is not None
+
+    def match(self, path):
+        """Return True if absolute 'path' matches any pattern."""
+        node = self.trie
+        if None in node:
+            return True
+        for component in path.split("/"):
+            if not component:
+                continue
+            node = node.get(component)
+            if node is None:
+                break
+            if None in node:
+                return True
+        return self.regex is not None and self.regex.match(path) is not None
+
+class PathScope:
+    """Set of paths specified by include and exclude patterns (see
+    PathMatcher). If there are no include patterns, all paths which do
+    not match exclude patterns are in the scope.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = PathMatcher(include)
+        self.exclude = PathMatcher(exclude)
+
+    def __contains__(self, path):
+        """Return True if absolute 'path' is in the scope."""
+        if self.include and not self.include.match(path):
+            return False
+        return not self.exclude.match(path)
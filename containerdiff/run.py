@@ -32,8 +32,13 @@ import shutil
 import containerdiff
 
 from containerdiff import undocker
+from containerdiff import graphdriver
 from containerdiff import modules
-from containerdiff.filter import filter_output
+from containerdiff.modules import metadata
+from containerdiff import budget
+from containerdiff import store
+from containerdiff.filter import filter_output, load_filter
+from containerdiff.pathscope import PathScope
 
 # Import program_version and program_desctiptions
 from containerdiff import program_description, program_version
@@ -43,6 +48,64 @@ logger = logging.getLogger(__name__)
 # Get default file for filtering options
 default_filter = os.path.join(os.path.dirname(__file__), "filter.json")
 
+# Results of compare_images
+IDENTICAL = "identical"
+SAME_LAYERS = "same layers"
+DIFFERENT = "different"
+
+def inspect_images(names):
+    """Return list of `docker inspect` outputs for images 'names'."""
+    cli = docker.AutoVersionClient(base_url = containerdiff.docker_socket)
+    result = []
+    for name in names:
+        try:
+            result.append(cli.inspect_image(name))
+        except docker.errors.NotFound:
+            logger.critical("Can't find image %s. Exit!", name)
+            raise
+    return result
+
+def compare_images(inspect1, inspect2):
+    """Compare images using only `docker inspect` output.
+
+    Returns IDENTICAL if images have the same ID (so the same config
+    digest), SAME_LAYERS if images have the same list of layer diff IDs
+    ("RootFS:Layers") - file content is same and only configuration
+    differ, otherwise DIFFERENT.
+    """
+    if inspect1["Id"] == inspect2["Id"]:
+        return IDENTICAL
+    layers1 = inspect1.get("RootFS", {}).get("Layers")
+    layers2 = inspect2.get("RootFS", {}).get("Layers")
+    if layers1 and layers1 == layers2:
+        return SAME_LAYERS
+    return DIFFERENT
+
+def quick_check(args):
+    """Check whether two images are equivalent without extracting them.
+
+    Images are equivalent if they are IDENTICAL or they have the SAME_LAYERS
+    and their metadata are same except 'volatile_paths' (see
+    modules.metadata).
+
+    'args' is a dictionary with the same keys as for function 'run'
+    (only 'imageID', 'log_level' and 'host' are used). Returns True if
+    images are equivalent.
+    """
+    logging.basicConfig(level=args["log_level"])
+    if args["host"]:
+        containerdiff.docker_socket = args["host"]
+
+    inspect1, inspect2 = inspect_images(args["imageID"])
+    verdict = compare_images(inspect1, inspect2)
+    logger.info("Images are %s", verdict)
+    if verdict != SAME_LAYERS:
+        return verdict == IDENTICAL
+
+    diff = metadata.diff_structures(inspect1, inspect2, ignore=frozenset(metadata.volatile_paths))
+    logger.info("Metadata changes: %s", diff)
+    return not any(diff.values())
+
 def run(args):
     """This function generates diff output.
 
@@ -54,7 +117,18 @@ def run(args):
     is a list of two strings identifying docker images, 'log_level' --
     value is a number 10-50. Optionally it can contain key/value pairs,
     which corresponds to containerdiff parameters ('silent', 'filter',
-    'output', 'host' or 'directory' - for --preserve option).
+    'output', 'database', 'host', 'ignore_volatile', 'summary_depth',
+    'max_diff_size', 'time_budget', 'paths', 'exclude_paths', 'store',
+    'graph_driver' or 'directory' - for --preserve option).
+
+    Modules run in order of their 'priority' attribute, so cheap tests
+    run first. Images are extracted just before the first module with
+    'needs_extraction' attribute set. If the time budget is exceeded the
+    output of remaining modules is marked as "not compared".
+
+    If both images have the same layers (see 'compare_images'), modules
+    with 'empty_result' function are not run and images are not
+    extracted at all.
 
     Return value is the output of the containerdiff.
     """
@@ -69,28 +143,44 @@ def run(args):
     if args["silent"]:
         containerdiff.silent = args["silent"]
 
+    # Do not compare metadata which differ for every build
+    if args.get("ignore_volatile"):
+        containerdiff.ignore_volatile = True
+
+    # Show only counts of changed files in directories
+    if args.get("summary_depth"):
+        containerdiff.summary_depth = args["summary_depth"]
+
+    # Set maximal size of files compared line by line
+    if args.get("max_diff_size") is not None:
+        containerdiff.max_diff_size = args["max_diff_size"]
+
+    # Restrict extraction and tests to some paths
+    if args.get("paths") or args.get("exclude_paths"):
+        containerdiff.path_scope = PathScope(args.get("paths") or [], args.get("exclude_paths") or [])
+
+    # Read layers directly from graph driver storage
+    if args.get("graph_driver"):
+        containerdiff.graph_driver = True
+
+    # Start measuring time budget
+    budget.start(args.get("time_budget"))
+
     # Get full image IDs
-    ID1 = None
-    ID2 = None
-    cli = docker.AutoVersionClient(base_url = containerdiff.docker_socket)
-    try:
-        ID1 = cli.inspect_image(args["imageID"][0])["Id"]
-    except docker.errors.NotFound:
-        logger.critical("Can't find image %s. Exit!", args["imageID"][0])
-        raise
-    try:
-        ID2 = cli.inspect_image(args["imageID"][1])["Id"]
-    except docker.errors.NotFound:
-        logger.critical("Can't find image %s. Exit!", args["imageID"][1])
-        raise
+    inspect1, inspect2 = inspect_images(args["imageID"])
+    ID1 = inspect1["Id"]
+    ID2 = inspect2["Id"]
     logger.info("ID1 - "+ID1)
     logger.info("ID2 - "+ID2)
 
+    # Images with the same layers have the same files and packages
+    verdict = compare_images(inspect1, inspect2)
+    logger.info("Images are %s", verdict)
+
     # Prepare filtering
     if args["filter"]:
-        with open(args["filter"]) as filter_file:
-            logger.debug("Using %s to get filter optins", args["filter"])
-            filter_options = json.load(filter_file)
+        logger.debug("Using %s to get filter optins", args["filter"])
+        filter_options = load_filter(args["filter"])
 
     try:
         extract_dir = "/tmp"
@@ -98,23 +188,47 @@ def run(args):
             extract_dir = args["directory"]
         output_dir1 = tempfile.mkdtemp(dir=extract_dir)
         output_dir2 = tempfile.mkdtemp(dir=extract_dir)
+        # Same files of both images are stored only once
+        store_dir = args.get("store")
+        if not store_dir:
+            store_dir = tempfile.mkdtemp(dir=extract_dir)
 
-        metadata1 = undocker.extract(ID1, output_dir1)
-        metadata2 = undocker.extract(ID2, output_dir2)
+        image1 = (ID1, None, output_dir1)
+        image2 = (ID2, None, output_dir2)
+        extracted = False
 
-        image1 = (ID1, metadata1, output_dir1)
-        image2 = (ID2, metadata2, output_dir2)
+        # Load modules and sort them to run cheap modules first
+        module_list = []
+        for _, module_name, _ in pkgutil.iter_modules([os.path.dirname(modules.__file__)]):
+            module_list.append(importlib.import_module(modules.__package__+"."+module_name))
+        module_list.sort(key=lambda module: getattr(module, "priority", 50))
 
         result = {}
         # Run modules and optionally do filtering
-        for _, module_name, _ in pkgutil.iter_modules([os.path.dirname(modules.__file__)]):
-            module = importlib.import_module(modules.__package__+"."+module_name)
+        for module in module_list:
+            module_name = module.__name__.split(".")[-1]
             module_result = {}
+            if verdict != DIFFERENT and hasattr(module, "empty_result"):
+                logger.info("Skipping modules.%s, images have the same layers", module_name)
+                result.update(module.empty_result())
+                continue
+            if not hasattr(module, "run"):
+                logger.error("Module file %s.py does not contain function run(image1, image2, verbosity)", module_name)
+                continue
             try:
+                if getattr(module, "needs_extraction", False) and not extracted:
+                    extractor = graphdriver if containerdiff.graph_driver else undocker
+                    metadata1 = extractor.extract(ID1, output_dir1, scope=containerdiff.path_scope, store=store_dir)
+                    metadata2 = extractor.extract(ID2, output_dir2, scope=containerdiff.path_scope, store=store_dir)
+                    image1 = (ID1, metadata1, output_dir1)
+                    image2 = (ID2, metadata2, output_dir2)
+                    extracted = True
                 logger.info("Going to run modules.%s", module_name)
                 module_result = module.run(image1, image2)
-            except AttributeError:
-                logger.error("Module file %s.py does not contain function run(image1, image2, verbosity)", module_name)
+            except budget.TimeBudgetExceeded as e:
+                logger.warning("modules.%s: %s", module_name, e)
+                result[module_name] = budget.NOT_COMPARED
+                continue
             if args["filter"]:
                 # Module can return dict with more keys
                 for key in module_result.keys():
@@ -130,6 +244,13 @@ def run(args):
             with open(args["output"], "w") as fd:
                 fd.write(json.dumps(result))
 
+        if args.get("database"):
+            store.write_result(args["database"], ID1, ID2, result, args["imageID"])
+
+        # Extracted files are hard links or copies of files in the store
+        if not args.get("store"):
+            shutil.rmtree(store_dir)
+
         # Remove temporary directories
         if not args["directory"]:
             logger.debug("Removing temporary directories")
@@ -149,6 +270,8 @@ def run(args):
         logger.debug("Error occured - cleaning temporary directories")
         shutil.rmtree(output_dir1, ignore_errors=True)
         shutil.rmtree(output_dir2, ignore_errors=True)
+        if not args.get("store"):
+            shutil.rmtree(store_dir, ignore_errors=True)
         raise
 
 def main():
@@ -161,7 +284,17 @@ def main():
     parser.add_argument("-s", "--silent", help="Lower verbosity of diff output. See help of individual modules.", action="store_true")
     parser.add_argument("-f", "--filter", help="Enable filtering. Optionally specify JSON file with options (preinstalled 'filter.json' by default).", type=str, const=default_filter, nargs="?")
     parser.add_argument("-o", "--output", help="Output file.", type=str)
+    parser.add_argument("--database", help="Append output to SQLite database.", type=str)
+    parser.add_argument("-q", "--quick", help="Only check whether images are equivalent (same layers and metadata except fields which differ for every build). Exit status is 0 for equivalent images, 1 otherwise.", action="store_true")
     parser.add_argument("-p", "--preserve", help="Do not remove directories with extracted images. Optionally specify directory where to extact images ('/tmp' by default).", type=str, const="/tmp", nargs="?", dest="directory")
+    parser.add_argument("--store", help="Directory with content addressed store of extracted files. It can be reused by more runs (temporary directory by default).", type=str)
+    parser.add_argument("--graph-driver", help="Read layers directly from the storage of docker graph driver (overlay2) if it is accessible instead of saving images by docker API.", action="store_true")
+    parser.add_argument("--paths", help="Extract and test only files under path prefix or matching glob. Can be used multiple times.", action="append", metavar="PATH")
+    parser.add_argument("--exclude-paths", help="Do not extract and test files under path prefix or matching glob. Can be used multiple times.", action="append", metavar="PATH")
+    parser.add_argument("--ignore-volatile", help="Do not compare image metadata which differ for every build (e.g. 'Id' or 'Created').", action="store_true")
+    parser.add_argument("--dir-summary", help="Show only counts of changed files in directories. Optionally specify how many path components are used to group files (2 by default).", type=int, const=2, nargs="?", dest="summary_depth")
+    parser.add_argument("--max-diff-size", help="Maximal size of files (in bytes) which are compared line by line ("+str(containerdiff.max_diff_size)+" by default).", type=int)
+    parser.add_argument("--time-budget", help="Limit the time of the run (in seconds). Tests which can not be finished in time are marked as 'not compared' in the output.", type=float)
     parser.add_argument("--host", help="Docker daemon socket to connect to", type=str)
     parser.add_argument("-l", "--logging", help="Print additional logging information.", default=logging.WARN,  type=int, choices=[logging.DEBUG, logging.INFO, logging.WARN, logging.ERROR, logging.CRITICAL], dest="log_level")
     parser.add_argument("-d", "--debug", help="Print additional debug information (= -l "+str(logging.DEBUG)+").", action="store_const", const=logging.DEBUG, dest="log_level")
@@ -169,6 +302,9 @@ def main():
     parser.add_argument("imageID", help="Docker ID of image", nargs=2)
     args = parser.parse_args()
 
+    if args.quick:
+        sys.exit(0 if quick_check(args.__dict__) else 1)
+
     result = run(args.__dict__)
     # If not specified file for the output
     if not args.output:
@@ -0,0 +1,162 @@
+#   ContainerDiff - tool to show differences among container images
+#
+#   Copyright (C) 2016 Marek Skalicky mskalick@redhat.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with containerdiff.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Store the output of containerdiff in SQLite database.
+
+Results of many runs can be stored in one database. Each run adds one
+row to table "pairs" and rows referencing it to tables "files",
+"packages" and "metadata". Columns "path" and "name" are indexed, so
+for example images with changes under /etc/ssl are found by
+
+  SELECT DISTINCT image1, image2 FROM files JOIN pairs ON pair = id
+    WHERE path = '/etc/ssl' OR path BETWEEN '/etc/ssl/' AND '/etc/ssl0'
+"""
+
+import json
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS pairs (
+    id INTEGER PRIMARY KEY,
+    image1 TEXT NOT NULL,
+    image2 TEXT NOT NULL,
+    name1 TEXT,
+    name2 TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pairs_images ON pairs (image1, image2);
+
+CREATE TABLE IF NOT EXISTS files (
+    pair INTEGER NOT NULL REFERENCES pairs (id),
+    path TEXT NOT NULL,
+    change TEXT NOT NULL,
+    mime TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_pair ON files (pair);
+
+CREATE TABLE IF NOT EXISTS packages (
+    pair INTEGER NOT NULL REFERENCES pairs (id),
+    name TEXT NOT NULL,
+    change TEXT NOT NULL,
+    old_version TEXT,
+    new_version TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+CREATE INDEX IF NOT EXISTS packages_pair ON packages (pair);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    pair INTEGER NOT NULL REFERENCES pairs (id),
+    path TEXT NOT NULL,
+    change TEXT NOT NULL,
+    old_value TEXT,
+    new_value TEXT
+);
+CREATE INDEX IF NOT EXISTS metadata_path ON metadata (path);
+CREATE INDEX IF NOT EXISTS metadata_pair ON metadata (pair);
+"""
+
+def text(value):
+    """Return string 'value' which can be stored in SQLite. Paths with
+    bytes which are not valid UTF-8 (decoded with surrogateescape) are
+    stored with these bytes escaped (e.g. "\\xff").
+    """
+    if value is None:
+        return None
+    try:
+        return value.encode("utf-8", "surrogateescape").decode("utf-8", "backslashreplace")
+    except UnicodeEncodeError:
+        # Other lone surrogates (e.g. from JSON metadata)
+        return value.encode("utf-8", "backslashreplace").decode("utf-8")
+
+def file_rows(pair, files):
+    """Generate rows of table "files" from the output of files module.
+
+    Metadata changes (and changes of files installed by package manager)
+    are stored as JSON. File diffs are not stored.
+    """
+    if not isinstance(files, dict):
+        return
+    for change in ["added", "removed", "modified"]:
+        for item in files.get(change, []):
+            metadata = None
+            if len(item) > 3:
+                metadata = json.dumps(item[3])
+            yield (pair, text(item[0]), change, item[1], metadata)
+    for path in files.get("not_compared", []):
+        yield (pair, text(path), "not_compared", None, None)
+    for item in files.get("owned_modified", []):
+        if isinstance(item, str):
+            yield (pair, text(item), "owned_modified", None, None)
+        else:
+            yield (pair, text(item[0]), "owned_modified", None, json.dumps(item[1]))
+
+def package_rows(pair, packages):
+    """Generate rows of table "packages" from the output of packages
+    module.
+    """
+    if not isinstance(packages, dict):
+        return
+    for name, version in packages.get("added", []):
+        yield (pair, text(name), "added", None, text(version))
+    for name, version in packages.get("removed", []):
+        yield (pair, text(name), "removed", text(version), None)
+    for name, old_version, new_version in packages.get("modified", []):
+        yield (pair, text(name), "modified", text(old_version), text(new_version))
+
+def metadata_rows(pair, metadata):
+    """Generate rows of table "metadata" from the output of metadata
+    module. Values are stored as JSON.
+    """
+    if not isinstance(metadata, dict):
+        return
+    for path, value in metadata.get("added", []):
+        yield (pair, text(path), "added", None, json.dumps(value))
+    for path, value in metadata.get("removed", []):
+        yield (pair, text(path), "removed", json.dumps(value), None)
+    for path, old_value, new_value in metadata.get("modified", []):
+        yield (pair, text(path), "modified", json.dumps(old_value), json.dumps(new_value))
+
+def write_result(database, ID1, ID2, result, names=(None, None)):
+    """Append 'result' (output of containerdiff.run) for images 'ID1'
+    and 'ID2' to SQLite 'database'. 'names' are names of images used on
+    the command line.
+
+    All rows are inserted in one transaction. Returns ID of the new row
+    in table "pairs".
+    """
+    logger.info("Writing output to database %s", database)
+    connection = sqlite3.connect(database, timeout=60)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(schema)
+        with connection:
+            cursor = connection.execute("INSERT INTO pairs (image1, image2, name1, name2, created) VALUES (?, ?, ?, ?, ?)",
+                                        (ID1, ID2, names[0], names[1], time.time()))
+            pair = cursor.lastrowid
+            connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", file_rows(pair, result.get("files")))
+            connection.executemany("INSERT INTO packages VALUES (?, ?, ?, ?, ?)", package_rows(pair, result.get("packages")))
+            connection.executemany("INSERT INTO metadata VALUES (?, ?, ?, ?, ?)", metadata_rows(pair, result.get("metadata")))
+    finally:
+        connection.close()
+    return pair
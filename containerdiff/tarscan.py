@@ -0,0 +1,288 @@
+#   ContainerDiff - tool to show differences among container images
+#
+#   Copyright (C) 2016 Marek Skalicky mskalick@redhat.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with containerdiff.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Index members of tar archive without tarfile.
+
+Headers are read directly from a buffer (bytes or mmap) and only the
+index entries are created. Content of members is not read, so it can
+be taken from the buffer later using 'offset' and 'size' of an entry.
+
+Archives can be also read from a stream of blocks (see 'scan_stream'),
+so a layer can be indexed while it is being decompressed.
+
+ustar, GNU (long names) and PAX headers are supported.
+"""
+
+import os
+import tarfile
+import collections
+
+BLOCKSIZE = 512
+
+# Index entry of a tar member. 'offset' is the position of member
+# content in the buffer. 'path' is normalized (no leading "./" or "/",
+# no trailing "/").
+Entry = collections.namedtuple("Entry", ["path", "type", "mode", "size", "offset",
+                                         "linkname", "uid", "gid", "uname", "gname",
+                                         "mtime", "chksum", "devmajor", "devminor"])
+
+# Types of members which have content stored in the archive
+DATA_TYPES = (tarfile.REGTYPE, tarfile.AREGTYPE, tarfile.CONTTYPE)
+
+def nts(data):
+    """Convert NUL terminated bytes to string."""
+    end = data.find(b"\0")
+    if end != -1:
+        data = data[:end]
+    return data.decode("utf-8", "surrogateescape")
+
+def nti(data):
+    """Convert number field to int. Octal and base-256 (GNU)
+    encodings are supported.
+    """
+    if data[0] in (0o200, 0o377):
+        number = int.from_bytes(data[1:], "big")
+        if data[0] == 0o377:
+            number -= 256 ** (len(data)-1)
+        return number
+    end = data.find(b"\0")
+    if end != -1:
+        data = data[:end]
+    data = data.strip()
+    if not data:
+        return 0
+    try:
+        return int(data, 8)
+    except ValueError:
+        raise tarfile.ReadError("Invalid number field in tar header")
+
+def normalize(path):
+    """Return member path without leading "./" or "/" and trailing "/"."""
+    path = os.path.normpath(path.lstrip("/"))
+    if path == ".":
+        return ""
+    return path
+
+def parse_pax(data):
+    """Return dict of records from PAX extended header 'data'."""
+    records = {}
+    position = 0
+    while position < len(data) and data[position] != 0:
+        space = data.find(b" ", position)
+        if space == -1:
+            raise tarfile.ReadError("Invalid PAX header")
+        length = int(data[position:space])
+        if length <= 0:
+            raise tarfile.ReadError("Invalid PAX header")
+        keyword, _, value = data[space+1:position+length-1].partition(b"=")
+        records[keyword.decode("utf-8", "surrogateescape")] = value.decode("utf-8", "surrogateescape")
+        position += length
+    return records
+
+def padded(size):
+    """Return 'size' rounded up to whole blocks."""
+    return (size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+
+class BufferReader:
+    """Read tar archive stored in buffer 'buf' (bytes or mmap) between
+    offsets 'start' and 'end'.
+    """
+
+    def __init__(self, buf, start=0, end=None):
+        self.buf = buf
+        self.position = start
+        self.end = len(buf) if end is None else end
+
+    def read(self, size):
+        """Return next 'size' bytes (less at the end of archive)."""
+        data = self.buf[self.position:min(self.position+size, self.end)]
+        self.position += len(data)
+        return data
+
+    def seek(self, position):
+        """Move to 'position' in the buffer."""
+        self.position = position
+
+class StreamReader:
+    """Read tar archive from iterable of bytes 'blocks' (e.g. blocks of
+    decompressed layer). Blocks are read only when they are needed and
+    the archive can be read only forward.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.buffer = memoryview(b"")
+        self.position = 0
+
+    def chunks(self, size):
+        """Generate parts of next 'size' bytes as they are read from
+        blocks (without copying).
+        """
+        while size > 0:
+            if not self.buffer:
+                block = next(self.blocks, None)
+                if block is None:
+                    return
+                self.buffer = memoryview(block)
+                continue
+            part = self.buffer[:size]
+            self.buffer = self.buffer[len(part):]
+            self.position += len(part)
+            size -= len(part)
+            yield part
+
+    def read(self, size):
+        """Return next 'size' bytes (less at the end of archive)."""
+        if len(self.buffer) >= size:
+            data = self.buffer[:size].tobytes()
+            self.buffer = self.buffer[size:]
+            self.position += size
+            return data
+        return b"".join(self.chunks(size))
+
+    def seek(self, position):
+        """Skip data up to 'position' of the stream."""
+        if position < self.position:
+            raise tarfile.ReadError("Can't seek backwards in tar stream")
+        for _ in self.chunks(position - self.position):
+            pass
+
+def scan(buf, start=0, end=None):
+    """Generate index entries of tar archive stored in 'buf' between
+    offsets 'start' and 'end'.
+
+    Raises tarfile.ReadError for invalid headers or unsupported
+    members (GNU sparse files).
+    """
+    return scan_reader(BufferReader(buf, start, end))
+
+def scan_stream(blocks):
+    """Generate tuples (<Entry>, <content>) of tar archive read from
+    iterable of bytes 'blocks'. <content> is an iterable of blocks of
+    member content. It can be read only until the next tuple is
+    requested, unread content is skipped. 'offset' of entries is the
+    position in the stream.
+
+    Raises tarfile.ReadError as 'scan'.
+    """
+    reader = StreamReader(blocks)
+    for entry in scan_reader(reader):
+        if entry.type in DATA_TYPES:
+            yield entry, reader.chunks(entry.size)
+        else:
+            yield entry, ()
+
+def scan_reader(reader):
+    """Generate index entries of tar archive read by 'reader'
+    (BufferReader or StreamReader). When the generator continues, the
+    reader is moved after the content of the last entry.
+    """
+    global_pax = {}
+    pax = {}
+    longname = None
+    longlink = None
+    while True:
+        position = reader.position
+        header = reader.read(BLOCKSIZE)
+        if len(header) < BLOCKSIZE or header.count(0) == BLOCKSIZE:
+            # End of archive
+            break
+
+        chksum = nti(header[148:156])
+        if chksum != sum(header[:148]) + 256 + sum(header[156:]):
+            raise tarfile.ReadError("Invalid tar header checksum at offset %i" % position)
+
+        member_type = header[156:157]
+        size = nti(header[124:136])
+        offset = reader.position
+        if "size" in pax:
+            size = int(pax["size"])
+        # Next header follows the content (rounded to blocks)
+        next_position = offset + padded(size)
+
+        if member_type in (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.SOLARIS_XHDTYPE):
+            records = parse_pax(reader.read(size))
+            reader.seek(next_position)
+            if member_type == tarfile.XGLTYPE:
+                global_pax.update(records)
+            else:
+                pax = records
+            continue
+        if member_type == tarfile.GNUTYPE_LONGNAME:
+            longname = nts(reader.read(size))
+            reader.seek(next_position)
+            continue
+        if member_type == tarfile.GNUTYPE_LONGLINK:
+            longlink = nts(reader.read(size))
+            reader.seek(next_position)
+            continue
+        if member_type == tarfile.GNUTYPE_SPARSE or any(key.startswith("GNU.sparse.") for key in pax):
+            raise tarfile.ReadError("GNU sparse files are not supported")
+
+        name = nts(header[0:100])
+        if header[257:263] == tarfile.POSIX_MAGIC[:6] and header[345] != 0:
+            name = nts(header[345:500])+"/"+name
+        linkname = nts(header[157:257])
+        uid = nti(header[108:116])
+        gid = nti(header[116:124])
+        mtime = nti(header[136:148])
+        uname = nts(header[265:297])
+        gname = nts(header[297:329])
+
+        if longname is not None:
+            name = longname
+        if longlink is not None:
+            linkname = longlink
+        records = dict(global_pax, **pax) if global_pax else pax
+        name = records.get("path", name)
+        linkname = records.get("linkpath", linkname)
+        uid = int(records.get("uid", uid))
+        gid = int(records.get("gid", gid))
+        uname = records.get("uname", uname)
+        gname = records.get("gname", gname)
+        if "mtime" in records:
+            mtime = int(float(records["mtime"]))
+        pax = {}
+        longname = longlink = None
+
+        if member_type in (tarfile.AREGTYPE, tarfile.REGTYPE) and name.endswith("/"):
+            member_type = tarfile.DIRTYPE
+        elif member_type == tarfile.AREGTYPE:
+            member_type = tarfile.REGTYPE
+        if member_type == tarfile.LNKTYPE:
+            linkname = normalize(linkname)
+        if member_type not in DATA_TYPES and member_type in tarfile.SUPPORTED_TYPES:
+            # Content of other members is not stored in the archive
+            next_position = offset
+
+        yield Entry(normalize(name), member_type, nti(header[100:108]) & 0o7777, size, offset,
+                    linkname, uid, gid, uname, gname, mtime, chksum,
+                    nti(header[329:337]), nti(header[337:345]))
+        reader.seek(next_position)
+
+def get_info(entry):
+    """Return dict with information about 'entry' with the same keys
+    as tarfile.TarInfo.get_info.
+    """
+    name = entry.path
+    if entry.type == tarfile.DIRTYPE:
+        name += "/"
+    return {"name":name, "mode":entry.mode, "uid":entry.uid, "gid":entry.gid,
+            "size":entry.size, "mtime":entry.mtime, "chksum":entry.chksum,
+            "type":entry.type, "linkname":entry.linkname, "uname":entry.uname,
+            "gname":entry.gname, "devmajor":entry.devmajor, "devminor":entry.devminor}
@@ -21,33 +21,71 @@
 
 import json
 import os
+import hashlib
 import logging
 import tarfile
 import tempfile
 import shutil
+import mmap
+import fcntl
+import zlib
+import queue
+import threading
+import concurrent.futures
 import docker
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 import containerdiff
+from containerdiff import budget
+from containerdiff import tarscan
 
 from contextlib import closing
 
 logger = logging.getLogger(__name__)
 
-def find_layers(img, ID):
+# Size of blocks read while extracting file content
+block_size = 1024*1024
+
+# ioctl request to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
+# Mode of files in the content addressed store, the same as of files
+# created by open (os.umask can be read only by setting it)
+umask = os.umask(0)
+os.umask(umask)
+store_mode = 0o666 & ~umask
+
+# Number of threads decompressing layers (and number of layers
+# decompressed ahead of the extracted one)
+decode_workers = os.cpu_count() or 1
+
+# Number of decompressed blocks buffered for each layer
+decode_queue_size = 16
+
+# File properties which are part of the tree digest (mtime and chksum
+# are ignored in comparison of files)
+digest_properties = ["type", "mode", "uid", "gid", "uname", "gname", "size",
+                     "linkname", "devmajor", "devminor"]
+
+def find_layers(img, index, ID):
     """Returns a list of underlying layers for the layer 'ID'. First
     element of the list is a top layer and then the underlying layers -
     it is reversed order in which docker expands layers during
     container creation.
 
-    'img' is a TarFile object of open docker image.
+    'img' is a buffer with docker image archive and 'index' is a dict
+    {<member path>: <tarscan.Entry>} of the archive.
 
     The 'ID' has to be 'full ID' (64 characters long).
     """
     if len(ID) != 64:
         return []
 
-    with closing(img.extractfile('%s/json' % ID)) as fd:
-        info = json.loads(fd.read().decode('utf8'))
+    info = read_json(img, index, '%s/json' % ID)
 
     logger.debug('layer = %s', ID)
     for k in ['os', 'architecture', 'author', 'created']:
@@ -56,15 +94,490 @@ def find_layers(img, ID):
 
     result = [ID]
     if 'parent' in info:
-        result.extend(find_layers(img, info['parent']))
+        result.extend(find_layers(img, index, info['parent']))
 
     return result
 
-def extract(ID, output, one_layer=False, whiteouts=True):
+def resolve_member(index, name):
+    """Return tarscan.Entry of member 'name' from 'index'. Symbolic
+    links (docker save links the same layers of different images) are
+    followed.
+    """
+    entry = index[tarscan.normalize(name)]
+    while entry.type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+        if entry.type == tarfile.SYMTYPE:
+            name = os.path.join(os.path.dirname(entry.path), entry.linkname)
+        else:
+            name = entry.linkname
+        entry = index[tarscan.normalize(name)]
+    return entry
+
+def read_json(img, index, name):
+    """Return decoded JSON member 'name' of archive 'img'."""
+    entry = resolve_member(index, name)
+    return json.loads(img[entry.offset:entry.offset+entry.size].decode('utf8'))
+
+def oci_layers(img, index, name):
+    """Return list of layer blobs from OCI index or manifest 'name'.
+    For index the first manifest is used.
+    """
+    info = read_json(img, index, name)
+    if 'manifests' in info:
+        algorithm, digest = info['manifests'][0]['digest'].split(':')
+        return oci_layers(img, index, 'blobs/%s/%s' % (algorithm, digest))
+    return ['blobs/%s/%s' % tuple(layer['digest'].split(':')) for layer in info['layers']]
+
+def image_layers(img, index, ID):
+    """Return names of layer archives in the saved image 'img'. First
+    element of the list is the bottom layer.
+
+    Layers are found in 'manifest.json' (docker >= 1.10), in OCI
+    'index.json' or by parents of the layer 'ID' in legacy format.
+    """
+    if 'manifest.json' in index:
+        return read_json(img, index, 'manifest.json')[0]['Layers']
+    if 'index.json' in index:
+        return oci_layers(img, index, 'index.json')
+    return ['%s/layer.tar' % layer_id for layer_id in reversed(find_layers(img, index, ID))]
+
+def read_member(img, entry):
+    """Generate blocks of content of member 'entry' of archive 'img'."""
+    end = entry.offset+entry.size
+    for offset in range(entry.offset, end, block_size):
+        yield img[offset:min(offset+block_size, end)]
+
+def compression(img, entry):
+    """Return compression of layer 'entry' of archive 'img' ('gzip',
+    'zstd' or None for uncompressed layer).
+    """
+    magic = img[entry.offset:entry.offset+min(entry.size, 4)]
+    if magic.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    if magic.startswith(b'\x28\xb5\x2f\xfd'):
+        return 'zstd'
+    return None
+
+def inflate(img, entry):
+    """Generate decompressed blocks of layer 'entry' of archive 'img'.
+
+    gzip (also with more members) and zstd compressed layers are
+    supported. Blocks of gzip layers are at most 'block_size' bytes
+    long.
+    """
+    if compression(img, entry) == 'gzip':
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        for chunk in read_member(img, entry):
+            while chunk:
+                data = decompressor.decompress(chunk, block_size)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+                # gzip stream can contain more members
+                if decompressor.eof and decompressor.unused_data:
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    elif compression(img, entry) == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Layer %s is zstd compressed, but zstandard module is not installed" % entry.path)
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in read_member(img, entry):
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    else:
+        yield from read_member(img, entry)
+
+class DecodedLayer:
+    """Layer 'entry' of archive 'img' decompressed by a thread of
+    'executor'.
+
+    Decompressed blocks are passed to the extraction through a queue of
+    'decode_queue_size' blocks, so a layer is extracted while it is
+    being decompressed and the memory usage does not depend on the size
+    of the layer.
+    """
+
+    def __init__(self, executor, img, entry):
+        self.queue = queue.Queue(maxsize=decode_queue_size)
+        self.stopped = threading.Event()
+        self.future = executor.submit(self._decode, img, entry)
+
+    def _put(self, item):
+        """Put 'item' to the queue. Returns False if the layer was
+        closed.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode(self, img, entry):
+        logger.debug('Decompressing %s layer %s', compression(img, entry), entry.path)
+        try:
+            for block in inflate(img, entry):
+                if not self._put(block):
+                    return
+        except Exception as e:
+            # Error is raised in the extraction
+            self._put(e)
+            return
+        self._put(None)
+
+    def blocks(self):
+        """Generate decompressed blocks of the layer."""
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def close(self):
+        """Stop the decompression."""
+        self.stopped.set()
+        self.future.cancel()
+
+def remove_path(target):
+    """Remove file or directory tree 'target' if it exists."""
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    elif os.path.lexists(target):
+        os.unlink(target)
+
+def copy_file(source, target):
+    """Create file 'target' with the content of 'source'. Reflink
+    (copy-on-write clone, supported e.g. by btrfs or xfs) is used if
+    possible, otherwise the content is copied.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, block_size)
+
+def clone_file(source, target):
+    """Create file 'target' with the content of 'source'. Hard link is
+    used if possible, otherwise the file is copied (see 'copy_file').
+    """
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    copy_file(source, target)
+
+def store_content(store, digest, write):
+    """Return the path of file with content 'digest' in content
+    addressed 'store' directory ('<store>/<digest[:2]>/<digest>').
+
+    If the file is not in the store yet, it is created by function
+    'write' which gets the path of the new file.
+    """
+    stored = os.path.join(store, digest[:2], digest)
+    if not os.path.exists(stored):
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        # Other extraction can write the same file at the same time
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(stored))
+        os.close(fd)
+        write(temporary)
+        # Extracted files are hard links to the store, mkstemp creates
+        # files only readable by the owner
+        os.chmod(temporary, store_mode)
+        os.replace(temporary, stored)
+    return stored
+
+def extract_regular(entry, content, target, store=None):
+    """Write 'content' (iterable of blocks) of member 'entry' to file
+    'target'.
+
+    If 'store' directory is specified, the content is written to the
+    content addressed store (see 'store_content') only if it is not
+    there yet and 'target' is created from it (see 'clone_file'). So
+    the same files are stored only once. Content is read only once:
+    files up to 'block_size' are hashed in memory before they are
+    stored, bigger files are written to a temporary file in the store.
+
+    Returns sha256 digest of the file content.
+    """
+    digest = hashlib.sha256()
+    if store is None:
+        with open(target, 'wb') as dst:
+            for chunk in content:
+                digest.update(chunk)
+                dst.write(chunk)
+        return digest.hexdigest()
+
+    if entry.size <= block_size:
+        data = b''.join(content)
+        digest.update(data)
+        digest = digest.hexdigest()
+
+        def write(path):
+            with open(path, 'wb') as dst:
+                dst.write(data)
+
+        clone_file(store_content(store, digest, write), target)
+        return digest
+
+    fd, temporary = tempfile.mkstemp(dir=store)
+    try:
+        with open(fd, 'wb') as dst:
+            for chunk in content:
+                digest.update(chunk)
+                dst.write(chunk)
+        digest = digest.hexdigest()
+        stored = store_content(store, digest, lambda path: os.replace(temporary, path))
+    finally:
+        if os.path.lexists(temporary):
+            os.unlink(temporary)
+    clone_file(stored, target)
+    return digest
+
+def build_tree(metadata):
+    """Return dict {<directory path>: <set of paths in the directory>}
+    made from 'metadata' (result of 'extract').
+
+    Directories which are not in 'metadata' (layer does not contain
+    them, only files under them) are added too, so all paths are
+    reachable from "/".
+    """
+    children = {}
+    for path in metadata:
+        while path != "/":
+            parent = os.path.dirname(path)
+            siblings = children.setdefault(parent, set())
+            if path in siblings:
+                break
+            siblings.add(path)
+            path = parent
+    return children
+
+def tree_digests(metadata):
+    """Compute Merkle digests of all files in 'metadata'.
+
+    Digest of a file is computed from its properties (see
+    'digest_properties') and content digest. Digest of a directory is
+    computed from its properties and names and digests of files in it.
+    So two directories with the same digest have the same subtree.
+
+    Digest is stored under "tree_digest" key in the file metadata.
+    Returns digest of "/".
+    """
+    children = build_tree(metadata)
+    digests = {}
+
+    def node_digest(path):
+        digest = hashlib.sha256()
+        info = metadata.get(path)
+        if info is not None:
+            properties = [str(info[key]) for key in digest_properties]
+            properties.append(info.get("digest", ""))
+            digest.update("\0".join(properties).encode("utf-8", "surrogateescape"))
+        for child in sorted(children.get(path, ())):
+            digest.update(b"\0"+os.path.basename(child).encode("utf-8", "surrogateescape"))
+            digest.update(digests[child].encode("ascii"))
+        digests[path] = digest.hexdigest()
+        if info is not None:
+            info["tree_digest"] = digests[path]
+
+    # Deepest paths have to be processed first
+    for path in sorted(set(metadata) | set(children), key=lambda path: path.count("/"), reverse=True):
+        if path != "/":
+            node_digest(path)
+    node_digest("/")
+    return digests["/"]
+
+def remove_subtrees(metadata, directories, keep=False):
+    """Remove metadata of files under 'directories'. If 'keep' is
+    False, metadata of 'directories' are removed too.
+    """
+    if not directories:
+        return
+    prefixes = tuple(directory+'/' for directory in directories)
+    for path in [path for path in metadata if path.startswith(prefixes)]:
+        del metadata[path]
+    if not keep:
+        for directory in directories:
+            metadata.pop(directory, None)
+
+def archive_members(img, start=0, end=None):
+    """Generate tuples (<tarscan.Entry>, <content>) of tar archive stored
+    in buffer 'img' between offsets 'start' and 'end' (see
+    tarscan.scan_stream).
+    """
+    for entry in tarscan.scan(img, start, end):
+        if entry.type in tarscan.DATA_TYPES:
+            yield entry, read_member(img, entry)
+        else:
+            yield entry, ()
+
+def hide_lower(output, metadata, removed, opaque, added):
+    """Remove files of lower layers hidden by whiteouts of a layer from
+    folder 'output' and 'metadata'.
+
+    'removed' paths are removed with their subtrees, content of 'opaque'
+    directories is removed. Files in 'added' (extracted from the layer
+    itself) and directories containing them are kept.
+    """
+    if not removed and not opaque:
+        return
+    kept = set(added)
+    for path in added:
+        while path not in ('/', ''):
+            path = os.path.dirname(path)
+            kept.add(path)
+
+    def remove(path):
+        target = os.path.join(output, path.lstrip('/'))
+        if path not in kept:
+            remove_path(target)
+        elif os.path.isdir(target) and not os.path.islink(target):
+            for child in os.listdir(target):
+                remove(os.path.join(path, child))
+
+    for path in removed:
+        logger.debug('Removing path %s', path)
+        remove(path)
+    for directory in opaque:
+        logger.debug('Removing content of %s', directory)
+        target = os.path.join(output, directory.lstrip('/'))
+        if os.path.isdir(target) and not os.path.islink(target):
+            for child in os.listdir(target):
+                remove(os.path.join(directory, child))
+
+    removed = set(removed)
+    prefixes = tuple(path.rstrip('/')+'/' for path in removed.union(opaque))
+    for path in [path for path in metadata if path not in added and (path in removed or path.startswith(prefixes))]:
+        del metadata[path]
+
+def extract_layer(members, output, metadata, whiteouts=True, scope=None, store=None, reopen=None):
+    """Extract 'members' of a layer to folder 'output' and update
+    'metadata' (see 'extract').
+
+    'members' is an iterable of tuples (<tarscan.Entry>, <content>) (see
+    tarscan.scan_stream and 'archive_members'). Members are extracted in
+    one pass, so a layer can be extracted while it is being
+    decompressed.
+
+    Whiteouts ('.wh.<name>' and opaque '.wh..wh..opq' files) are
+    processed after other members of the layer (see 'hide_lower').
+
+    If 'scope' (pathscope.PathScope) is specified, members outside of
+    it are skipped. Only symbolic links are always extracted (without
+    metadata), so paths in the scope can be resolved. Hard links to
+    files outside of the scope are created at the end from members
+    returned by function 'reopen' (the same members read again).
+
+    Regular files are created from content addressed 'store' directory
+    if it is specified (see 'extract_regular').
+    """
+    # Paths extracted from the layer
+    added = set()
+    removed = []
+    opaque = []
+    # Hard links to files outside of the scope {<linkname>: [(<path>, <info>)]}
+    pending = {}
+    for entry, content in members:
+        if not entry.path or entry.path.startswith('..'):
+            continue
+        path = '/'+entry.path
+        directory, name = os.path.split(entry.path)
+        if whiteouts and name.startswith('.wh.'):
+            if name == '.wh..wh..opq':
+                opaque.append('/'+directory)
+            else:
+                removed.append('/'+os.path.join(directory, name[4:]))
+            continue
+
+        target = os.path.join(output, entry.path)
+        in_scope = scope is None or path in scope
+        if not in_scope and entry.type != tarfile.SYMTYPE:
+            continue
+        info = tarscan.get_info(entry)
+        added.add(path)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if entry.type == tarfile.DIRTYPE:
+            if not os.path.isdir(target) or os.path.islink(target):
+                remove_path(target)
+                os.mkdir(target)
+        elif entry.type in (tarfile.BLKTYPE, tarfile.CHRTYPE):
+            # Device files are not extracted
+            remove_path(target)
+        else:
+            remove_path(target)
+            if entry.type in tarscan.DATA_TYPES:
+                info['digest'] = extract_regular(entry, content, target, store)
+            elif entry.type == tarfile.SYMTYPE:
+                os.symlink(entry.linkname, target)
+            elif entry.type == tarfile.LNKTYPE:
+                source_path = os.path.join(output, entry.linkname)
+                if not os.path.lexists(source_path) and scope is not None and reopen is not None:
+                    # Target of the link can be outside of the scope
+                    pending.setdefault(entry.linkname, []).append((path, info))
+                    continue
+                source = metadata.get('/'+entry.linkname, {})
+                if 'digest' in source:
+                    info['digest'] = source['digest']
+                try:
+                    os.link(source_path, target, follow_symlinks=False)
+                except OSError as e:
+                    logger.warning("Can't create hard link %s: %s", path, e)
+            elif entry.type == tarfile.FIFOTYPE:
+                os.mkfifo(target)
+
+        if in_scope:
+            metadata[path] = info
+
+    if pending:
+        for entry, content in reopen():
+            if entry.path not in pending or entry.type not in tarscan.DATA_TYPES:
+                continue
+            links = pending.pop(entry.path)
+            first = os.path.join(output, links[0][0].lstrip('/'))
+            digest = extract_regular(entry, content, first, store)
+            for path, info in links:
+                if path != links[0][0]:
+                    os.link(first, os.path.join(output, path.lstrip('/')))
+                info['digest'] = digest
+                metadata[path] = info
+            if not pending:
+                break
+        for links in pending.values():
+            for path, info in links:
+                logger.warning("Can't create hard link %s: target not found", path)
+
+    hide_lower(output, metadata, removed, opaque, added)
+
+def extract(ID, output, one_layer=False, whiteouts=True, scope=None, store=None):
     """Extract the content of image *ID* to folder *output*.
 
-    If *one_layer* is True only layer *ID* is extracted. If *whiteouts*
-    is False there is no logic with files started with '.wh.'.
+    If *one_layer* is True only the top layer of *ID* is extracted. If
+    *whiteouts* is False there is no logic with files started with '.wh.'
+    (including opaque directories marked by '.wh..wh..opq').
+
+    If *scope* (pathscope.PathScope) is specified, only files in the
+    scope are extracted (see 'extract_layer').
+
+    If *store* directory is specified, files are hard linked (or copied)
+    from this content addressed store. It can be shared by more images
+    and runs, so the same files are written only once.
+
+    Archives are indexed by tarscan, content of files is copied directly
+    from memory mapped archives.
+
+    Layers can be uncompressed, gzip or zstd (requires zstandard module)
+    compressed. They are decompressed by 'decode_workers' threads and
+    extracted while they are being decompressed (see 'DecodedLayer').
+
+    Raises budget.TimeBudgetExceeded if the time budget is exceeded
+    before the extraction of a layer.
 
     File information like owner, modification time and permissions is
     not set. It is stored in the dict structure with 'path to the file'
@@ -72,6 +585,10 @@ def extract(ID, output, one_layer=False, whiteouts=True):
 
     Device files are not extracted. Only the additional metadata are
     stored in returned dictionary.
+
+    Metadata of regular files also contain "digest" key (sha256 of the
+    file content) and metadata of all files contain "tree_digest" key
+    (see 'tree_digests').
     """
     metadata = {}
 
@@ -82,56 +599,65 @@ def extract(ID, output, one_layer=False, whiteouts=True):
         logger.critical("Can't find image %s", ID)
         raise
 
+    budget.check('extraction of image %s' % ID)
     logger.info('Saving image %s', ID)
     image = cli.get_image(ID)
 
     with tempfile.NamedTemporaryFile() as fd:
         fd.write(image.data)
+        fd.flush()
 
-        with tarfile.open(name=fd.name) as img:
+        with closing(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)) as img:
             logger.info('Extracting image %s', ID)
-            # Get ID of the first layer if docker uses content addressability
-            if ('manifest.json' and ID.split(':')[-1]+'.json') in img.getnames():
-                with closing(img.extractfile('manifest.json')) as fd:
-                    manifest = json.loads(fd.read().decode('utf8'))
-                ID = manifest[0]['Layers'][-1].split('/')[0]
-
-            if not one_layer:
-                layers = find_layers(img, ID)
-            else:
-                layers = [ID]
+            index = {entry.path: entry for entry in tarscan.scan(img)}
+            layers = image_layers(img, index, ID)
+            if one_layer:
+                layers = layers[-1:]
+            members = [resolve_member(index, name) for name in layers]
 
             if not os.path.isdir(output):
                 os.mkdir(output)
+            if store is not None:
+                os.makedirs(store, exist_ok=True)
 
-            for layer_id in reversed(layers):
-                logger.info('Extracting layer %s', layer_id)
-                with tarfile.TarFile(fileobj=
-                        img.extractfile('%s/layer.tar' % layer_id)) as layer:
-                    # Extract all members in a layer
-                    for member in layer.getmembers():
-                        path = member.path
-                        if whiteouts and (path.startswith('.wh.') or '/.wh.' in path):
-                            if path.startswith('.wh.'):
-                                newpath = path[4:]
-                            else:
-                                newpath = path.replace('/.wh.', '/')
-
-                            logger.debug('Removing path %s', newpath)
-                            del metadata['/'+newpath]
-                            newpath = os.path.join(output, newpath)
-
-                            if os.path.isdir(newpath):
-                                shutil.rmtree(newpath)
-                            else:
-                                os.unlink(newpath)
-                            continue
-
-                        metadata['/'+path] = member.get_info()
-
-                        if not member.isdev():
-                            layer.extract(member, path=output, set_attrs=False)
-                    logger.debug('Actual metadata size - %i', len(metadata))
+            # Compressed layers are decompressed by threads. Each layer is
+            # extracted while it is being decompressed and at most
+            # 'decode_workers' layers are decompressed ahead.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=decode_workers) as executor:
+                decoded = {}
 
-    return metadata
+                def decode(number):
+                    if number < len(members) and compression(img, members[number]) is not None:
+                        decoded[number] = DecodedLayer(executor, img, members[number])
+
+                try:
+                    for number in range(decode_workers):
+                        decode(number)
+                    for number, (name, member) in enumerate(zip(layers, members)):
+                        budget.check('extraction of layer %s' % name)
+                        logger.info('Extracting layer %s', name)
+                        start, end = member.offset, member.offset+member.size
+                        layer = decoded.pop(number, None)
+                        if layer is None:
+                            # Uncompressed layer is read directly from the image
+                            extract_layer(archive_members(img, start, end), output, metadata,
+                                          whiteouts, scope, store, lambda: archive_members(img, start, end))
+                        else:
+                            try:
+                                extract_layer(tarscan.scan_stream(layer.blocks()), output, metadata,
+                                              whiteouts, scope, store, lambda: tarscan.scan_stream(inflate(img, member)))
+                            finally:
+                                # Decompression thread waits for the queue
+                                # to be read until the layer is closed
+                                layer.close()
+                        decode(number+decode_workers)
+                        logger.debug('Actual metadata size - %i', len(metadata))
+                finally:
+                    # Stop decompression of remaining layers
+                    for layer in decoded.values():
+                        layer.close()
 
+    logger.info('Computing tree digests of image %s', ID)
+    tree_digests(metadata)
+
+    return metadata
@@ -40,6 +40,9 @@ setup(
         "docker_py",
         "file-magic",
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
 
     author = "Marek Skalicky",
     author_email = "MSkalicky@seznam.cz",